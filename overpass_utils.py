@@ -0,0 +1,242 @@
+"""Shared Overpass fetching, parsing, and pydeck helpers.
+
+Keeping these in one module means every Streamlit page that imports them
+shares the same st.cache_data / st.cache_resource entries, so the Overpass
+response is fetched and parsed once per process regardless of which page
+triggers it.
+"""
+
+import array
+import hashlib
+import math
+from pathlib import Path
+from typing import NamedTuple
+
+import streamlit as st
+import ijson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
+import pandas as pd
+import pydeck as pdk
+import h3
+
+# Overpass API endpoint
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+
+# Single Overpass query for trees and forests; the response is demultiplexed
+# by element type client-side, halving the HTTP round-trips. 'out skel qt'
+# keeps only ids and coordinates for the tree nodes (we never read tags,
+# versions, or usernames), which shrinks the payload regardless of compression
+QUERY_TEMPLATE = """
+[out:json][timeout:25];
+node["natural"="tree"]({bbox});
+out skel qt;
+(
+  way["landuse"="forest"]({bbox});
+  relation["landuse"="forest"]({bbox});
+);
+out geom qt;
+"""
+
+
+def snap_bbox(south, west, north, east, step=0.05):
+    # Enlarge the bbox outward to a coarse grid so small viewport changes
+    # still hash to the same cached Overpass query
+    return (
+        math.floor(south / step) * step,
+        math.floor(west / step) * step,
+        math.ceil(north / step) * step,
+        math.ceil(east / step) * step,
+    )
+
+
+def build_query(south, west, north, east):
+    bbox = ",".join("%.2f" % v for v in snap_bbox(south, west, north, east))
+    return QUERY_TEMPLATE.format(bbox=bbox)
+
+
+# One pooled session per process (st.cache_resource, since Streamlit re-runs
+# app modules on every interaction): keep-alive amortizes the TCP handshake
+# across fetches, and the retry policy backs off on Overpass 429s
+@st.cache_resource(show_spinner=False)
+def get_session():
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=1, status_forcelist=[429, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class MapData(NamedTuple):
+    df_trees: pd.DataFrame
+    forest_rings: list  # one flat float32 (lon, lat, lon, lat, ...) buffer per polygon
+    lat_center: float
+    lon_center: float
+
+
+# On-disk cache tier: st.cache_data only lives as long as the process, so a
+# server restart would make every visitor re-pay the Overpass round-trip.
+# Parsed results are persisted as Parquet keyed by the query hash.
+CACHE_DIR = Path("/tmp/overpass_cache")
+
+
+def _cache_paths(query: str):
+    key = hashlib.sha1(query.encode()).hexdigest()
+    return CACHE_DIR / (key + "_trees.parquet"), CACHE_DIR / (key + "_forest.parquet")
+
+
+def _read_disk_cache(query: str):
+    trees_path, forest_path = _cache_paths(query)
+    if not (trees_path.exists() and forest_path.exists()):
+        return None
+    try:
+        df_trees = pd.read_parquet(trees_path)
+        forest_rings = [
+            np.asarray(ring, dtype=np.float32)
+            for ring in pd.read_parquet(forest_path)["ring"]
+        ]
+    except (OSError, ValueError, KeyError):
+        return None
+    return df_trees, forest_rings
+
+
+def _write_disk_cache(query: str, df_trees, forest_rings):
+    trees_path, forest_path = _cache_paths(query)
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # zstd compresses the repetitive coordinate columns ~2x better than snappy
+        df_trees.to_parquet(trees_path, compression="zstd")
+        pd.DataFrame({"ring": forest_rings}).to_parquet(forest_path, compression="zstd")
+    except OSError:
+        pass  # a read-only or full disk just means the next restart is cold
+
+
+# Fetch tree and forest data in one round-trip and stream-parse the response
+# with ijson: elements are consumed one at a time off the wire, so peak memory
+# stays O(1) instead of holding the raw body plus the fully parsed JSON tree.
+# Node coordinates go straight into float32 buffers; the centroid is
+# precomputed so reruns don't rescan the lat/lon columns.
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_map_data(query: str) -> MapData:
+    cached = _read_disk_cache(query)
+    if cached is not None:
+        df_trees, forest_rings = cached
+        lat_center = float(df_trees["lat"].mean()) if not df_trees.empty else 40.75
+        lon_center = float(df_trees["lon"].mean()) if not df_trees.empty else -73.95
+        return MapData(df_trees, forest_rings, lat_center, lon_center)
+
+    lat_buf = array.array("f")
+    lon_buf = array.array("f")
+    forest_rings = []
+    fetched = False
+    try:
+        response = get_session().get(
+            OVERPASS_URL,
+            params={"data": query},
+            headers={"Accept-Encoding": "gzip"},  # pin gzip: tree JSON compresses ~10x
+            timeout=30,
+            stream=True,
+        )
+        response.raise_for_status()
+        response.raw.decode_content = True  # transparently gunzip for ijson
+        for element in ijson.items(response.raw, "elements.item"):
+            if element["type"] == "node":
+                lat_buf.append(float(element["lat"]))
+                lon_buf.append(float(element["lon"]))
+            elif "geometry" in element:
+                geometry = element["geometry"]
+                # Flat float32 (lon, lat) pairs instead of nested lists of
+                # Python floats: ~6x less memory and Parquet/Arrow-friendly
+                forest_rings.append(np.fromiter(
+                    (c for p in geometry for c in (float(p["lon"]), float(p["lat"]))),
+                    dtype=np.float32,
+                    count=2 * len(geometry),
+                ))
+        fetched = True
+    except requests.RequestException:
+        pass
+    df_trees = pd.DataFrame()
+    if lat_buf:
+        df_trees = pd.DataFrame({
+            "lat": np.frombuffer(lat_buf, dtype=np.float32),
+            "lon": np.frombuffer(lon_buf, dtype=np.float32),
+        })
+    if fetched:
+        _write_disk_cache(query, df_trees, forest_rings)
+    lat_center = float(df_trees["lat"].mean()) if not df_trees.empty else 40.75
+    lon_center = float(df_trees["lon"].mean()) if not df_trees.empty else -73.95
+    return MapData(df_trees, forest_rings, lat_center, lon_center)
+
+
+# Fixed H3 resolution (~170 m hexagons). Binning happens once in Python and
+# is cached, so zoom/pan is pure view-transform work on the GPU with no
+# client-side re-binning, and the cache key no longer churns with a slider
+H3_RESOLUTION = 9
+
+
+# Pre-aggregate tree points into (h3 cell, count) rows so pydeck ships one
+# row per occupied hexagon to the browser instead of every raw tree point
+@st.cache_data(show_spinner=False)
+def aggregate_hexbins(df):
+    cells = [h3.latlng_to_cell(lat, lon, H3_RESOLUTION) for lat, lon in zip(df["lat"], df["lon"])]
+    unique_cells, counts = np.unique(cells, return_counts=True)
+    return pd.DataFrame({
+        "h3": unique_cells,
+        "count": counts.astype(np.int32),
+    })
+
+
+# pydeck's JSON/HTML pipeline can't carry raw binary attribute buffers (that
+# transport is Jupyter-widget only), so the payload cut happens in the row
+# encoding instead: single-key [lon, lat] records rounded to 5 decimals (~1 m)
+# serialize to roughly half the bytes of full-precision lat/lon dicts
+@st.cache_data(show_spinner=False)
+def tree_positions(df):
+    positions = np.round(df[["lon", "lat"]].to_numpy(dtype=np.float64), 5)
+    return [{"p": p} for p in positions.tolist()]
+
+
+def make_hex_layer(df_hex, elevation_scale):
+    # H3HexagonLayer just draws the precomputed cells; no GPU re-binning
+    return pdk.Layer(
+        "H3HexagonLayer",
+        df_hex,
+        get_hexagon="h3",
+        get_elevation="count",
+        elevation_scale=elevation_scale,
+        extruded=True,
+        coverage=1,
+        get_fill_color=[100, 200, 100, 220],
+        pickable=True,
+    )
+
+
+def make_forest_layer(forest_rings):
+    # Rings live as flat float32 buffers; the nested lists the PolygonLayer
+    # JSON spec requires are expanded only here, inside the cached layer
+    # build, with the same 5-decimal trim as the tree positions
+    polygons = [
+        {"coordinates": [np.round(ring.astype(np.float64), 5).reshape(-1, 2).tolist()]}
+        for ring in forest_rings
+    ]
+    return pdk.Layer(
+        "PolygonLayer",
+        polygons,
+        get_polygon="coordinates",
+        get_fill_color=[0, 100, 0, 150],
+        get_line_color=[0, 50, 0, 200],
+        pickable=True,
+    )
+
+
+def make_view_state(data: MapData, zoom, pitch, bearing):
+    return pdk.ViewState(
+        longitude=data.lon_center,
+        latitude=data.lat_center,
+        zoom=zoom,
+        pitch=pitch,
+        bearing=bearing,
+    )
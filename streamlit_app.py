@@ -1,9 +1,28 @@
 import streamlit as st
-import requests
+import streamlit.components.v1 as components
+import numpy as np
 import pandas as pd
 import pydeck as pdk
 import openaq
 
+from overpass_utils import (
+    aggregate_hexbins,
+    build_query,
+    load_map_data,
+    make_forest_layer,
+    make_hex_layer,
+    make_view_state,
+    tree_positions,
+)
+
+# Read once at import; st.secrets caches the parsed secrets file, so this is
+# O(1) after the first access. A missing secret leaves pydeck on its default
+# anonymous basemap instead of crashing
+try:
+    MAPBOX_TOKEN = st.secrets["MAPBOX_TOKEN"]
+except (KeyError, FileNotFoundError):
+    MAPBOX_TOKEN = None
+
 st.title("🌳 Tree Map (New York)")
 st.markdown("Visualizing tree data with options for density, canopy coverage, heat island effect, and air quality correlation.")
 
@@ -12,7 +31,6 @@ with st.sidebar:
     st.header("Map Controls")
     view_option = st.radio("Select View", ["Tree Density", "Tree Canopy Coverage", "Heat Island Effect", "Air Quality Correlation"])
     zoom_level = st.slider("Zoom Level", 10, 18, 12)
-    radius = st.slider("Hexagon Radius (meters)", 50, 200, 50)
     elevation_scale = st.slider("Elevation Scale", 5, 20, 5)
     pitch = 45 if view_option == "Tree Density" else 0  # 3D for density, 2D otherwise
     bearing = st.slider("Map Bearing", 0, 360, 0)
@@ -27,48 +45,10 @@ For **Air Quality Correlation**, tree coverage is compared against AQI data from
 Higher density areas will have more intense colors in the heatmap.
 """)
 
-# Overpass API endpoint
-url = "http://overpass-api.de/api/interpreter"
-
-# Overpass Query for Trees in New York
-query_trees = """
-[out:json];
-(
-  node["natural"="tree"](40.70,-74.00,40.80,-73.90);
-);
-out;
-"""
-
-query_forest = """
-[out:json];
-(
-  way["landuse"="forest"](40.70,-74.00,40.80,-73.90);
-);
-out geom;
-"""
-
-# Fetch tree data
-response_trees = requests.get(url, params={"data": query_trees})
-response_forest = requests.get(url, params={"data": query_forest})
-
-tree_locations = []
-df_trees = pd.DataFrame()
-forest_polygons = []
-
-if response_trees.status_code == 200:
-    data_trees = response_trees.json()
-    tree_locations = [
-        {"lat": element["lat"], "lon": element["lon"]}
-        for element in data_trees.get("elements", [])
-    ]
-    df_trees = pd.DataFrame(tree_locations)
-
-if response_forest.status_code == 200:
-    data_forest = response_forest.json()
-    forest_polygons = [
-        {"coordinates": [[(p["lon"], p["lat"]) for p in element["geometry"]]]}
-        for element in data_forest.get("elements", [])
-    ]
+query_osm = build_query(40.70, -74.00, 40.80, -73.90)
+
+map_data = load_map_data(query_osm)
+df_trees = map_data.df_trees
 
 # Fetch AQI data from OpenAQ
 api = openaq.OpenAQ()
@@ -86,75 +66,98 @@ def fetch_aqi_data(city='New York'):
 
 df_aqi = fetch_aqi_data()
 
-def create_layer():
-    hex_layer = pdk.Layer(
-        "HexagonLayer",
-        df_trees,
-        get_position=["lon", "lat"],
-        radius=radius,
-        elevation_scale=elevation_scale,
-        elevation_range=[0, 1000],
-        extruded=True,
-        coverage=1,
-        color_range=[
-            [0, 50, 0], [100, 200, 100], [150, 255, 150],
-            [255, 255, 100], [255, 100, 50], [255, 0, 0]
-        ],
-        pickable=True,
-    )
-    canopy_layer = pdk.Layer(
-        "ScatterplotLayer",
-        df_trees,
-        get_position=["lon", "lat"],
-        get_radius=5,
-        get_fill_color=[0, 0, 255, 255],
-        pickable=True,
-    )
-    forest_layer = pdk.Layer(
-        "PolygonLayer",
-        forest_polygons,
-        get_polygon="coordinates",
-        get_fill_color=[0, 100, 0, 150],
-        get_line_color=[0, 50, 0, 200],
-        pickable=True,
-    )
-    # aqi_layer = pdk.Layer(
-    #     "ScatterplotLayer",
-    #     df_aqi,
-    #     get_position=["longitude", "latitude"],
-    #     get_color=[255, 0, 0, 160],
-    #     get_radius=200,
-    #     pickable=True,
-    # )
-    if view_option == "Tree Density":
-        return [hex_layer]
-    elif view_option == "Tree Canopy Coverage":
-        return [canopy_layer, forest_layer]
-    elif view_option == "Air Quality Correlation":
-        # return [aqi_layer, canopy_layer, forest_layer]
+# Layers are pure functions of the cached data plus these controls, so reuse
+# them across reruns instead of reconstructing pdk.Layer objects every time
+@st.cache_resource(show_spinner=False)
+def build_layers(query, view_option, elevation_scale):
+    data = load_map_data(query)
+    df_trees = data.df_trees
+    if df_trees.empty:
+        return []
+
+    def density_layers():
+        return [make_hex_layer(aggregate_hexbins(df_trees), elevation_scale)]
+
+    def canopy_layers():
+        canopy_layer = pdk.Layer(
+            "ScatterplotLayer",
+            tree_positions(df_trees),
+            get_position="p",
+            get_radius=5,
+            get_fill_color=[0, 0, 255, 255],
+            pickable=True,
+        )
+        return [canopy_layer, make_forest_layer(data.forest_rings)]
+
+    def heat_layers():
+        # Simulated temperature per tree point; only built when this view is
+        # active, so the other views never pay for the extra copy. Built from
+        # a raw arange rather than df.index so pandas never materializes
+        # intermediate Index arrays
+        temps = 30.0 - (np.arange(len(df_trees), dtype=np.int32) % 5).astype(np.float32)
+        heat_layer = pdk.Layer(
+            "HeatmapLayer",
+            df_trees.assign(temperature=temps),
+            get_position=["lon", "lat"],
+            get_weight="temperature",
+            aggregation="MEAN",
+        )
+        return [heat_layer]
+
+    def aqi_layers():
+        # aqi_layer = pdk.Layer(
+        #     "ScatterplotLayer",
+        #     df_aqi,
+        #     get_position=["longitude", "latitude"],
+        #     get_color=[255, 0, 0, 160],
+        #     get_radius=200,
+        #     pickable=True,
+        # )
+        # return [aqi_layer] + canopy_layers()
         print("LOL")
-    return []
+        return []
+
+    # Only the selected view's builder runs, so unused layers (and the
+    # DataFrames behind them) are never constructed or validated
+    dispatch = {
+        "Tree Density": density_layers,
+        "Tree Canopy Coverage": canopy_layers,
+        "Heat Island Effect": heat_layers,
+        "Air Quality Correlation": aqi_layers,
+    }
+    return dispatch[view_option]()
 
-if not df_trees.empty:
-    layers = create_layer()
-    view_state = pdk.ViewState(
-        longitude=df_trees["lon"].mean() if not df_trees.empty else -73.95,
-        latitude=df_trees["lat"].mean() if not df_trees.empty else 40.75,
-        zoom=zoom_level,
-        pitch=pitch,
-        bearing=bearing,
-    )
+# The Deck itself is keyed on every control value, so a repeated combination
+# of slider positions reuses the already-built object
+@st.cache_resource(show_spinner=False)
+def build_deck(query, view_option, zoom_level, elevation_scale, pitch, bearing):
+    data = load_map_data(query)
+    view_state = make_view_state(data, zoom_level, pitch, bearing)
 
     tooltip = {
-        "html": "<b>Location:</b> {location} <br/> <b>PM2.5:</b> {value} µg/m³" if view_option == "Air Quality Correlation" else "<b>Tree Data:</b> {elevationValue}",
+        "html": "<b>Location:</b> {location} <br/> <b>PM2.5:</b> {value} µg/m³" if view_option == "Air Quality Correlation" else "<b>Trees:</b> {count}",
         "style": {"backgroundColor": "steelblue", "color": "white"}
     }
 
-    deck = pdk.Deck(
-        layers=layers,
+    return pdk.Deck(
+        layers=build_layers(query, view_option, elevation_scale),
         initial_view_state=view_state,
+        map_provider="mapbox",
         map_style="mapbox://styles/mapbox/light-v10",
+        api_keys={"mapbox": MAPBOX_TOKEN} if MAPBOX_TOKEN else None,
         tooltip=tooltip
     )
 
-    st.pydeck_chart(deck)
+# st.pydeck_chart re-serializes the whole deck spec (layer data included) on
+# every rerun; caching the rendered HTML means the per-interaction path just
+# hands the browser a prebuilt string
+@st.cache_data(show_spinner=False)
+def build_deck_html(query, view_option, zoom_level, elevation_scale, pitch, bearing) -> str:
+    deck = build_deck(query, view_option, zoom_level, elevation_scale, pitch, bearing)
+    return deck.to_html(as_string=True, notebook_display=False)
+
+if not df_trees.empty:
+    components.html(
+        build_deck_html(query_osm, view_option, zoom_level, elevation_scale, pitch, bearing),
+        height=500,
+    )